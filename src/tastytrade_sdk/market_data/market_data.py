@@ -22,14 +22,23 @@ class MarketData:
                   symbols: List[str],
                   on_candle: Callable[[dict], None] = None,
                   on_greeks: Callable[[dict], None] = None,
-                  on_quote: Callable[[dict], None] = None
+                  on_quote: Callable[[dict], None] = None,
+                  on_candle_batch: Callable[[List[tuple]], None] = None,
+                  on_greeks_batch: Callable[[List[tuple]], None] = None,
+                  on_quote_batch: Callable[[List[tuple]], None] = None
                   ) -> Subscription:
         """
         Subscribe to live feed data
         :param symbols: Symbols to subscribe to. Can be across multiple instrument types.
-        :param on_candle: Handler for candle events
-        :param on_greeks: Handler for greeks events
-        :param on_quote: Handler for quote events
+        :param on_candle: Handler for candle events, called once per event
+        :param on_greeks: Handler for greeks events, called once per event
+        :param on_quote: Handler for quote events, called once per event
+        :param on_candle_batch: Handler for candle event batches, called once per burst of feed messages with a list of
+        `(Symbol, eventSymbol, Open, High, Low, Close, Volumen, timeStamp)` tuples
+        :param on_greeks_batch: Handler for greeks event batches, called once per burst of feed messages with a list of
+        `(Symbol, eventSymbol, Price, Volatility, Delta, Gamma, Theta, Rho, Vega, timeStamp)` tuples
+        :param on_quote_batch: Handler for quote event batches, called once per burst of feed messages with a list of
+        `(Symbol, eventSymbol, bidPrice, askPrice, timeStamp)` tuples
         """
         data = self.__api.get('/quote-streamer-tokens')['data']
         return Subscription(
@@ -38,5 +47,8 @@ class MarketData:
             self.__streamer_symbol_translations_factory.create(symbols),
             on_candle=on_candle,
             on_greeks=on_greeks,
-            on_quote=on_quote
+            on_quote=on_quote,
+            on_candle_batch=on_candle_batch,
+            on_greeks_batch=on_greeks_batch,
+            on_quote_batch=on_quote_batch
         )
@@ -1,22 +1,56 @@
 import logging
+import queue
 import threading
 import time
-from itertools import product
-from math import floor
-from typing import Callable, Optional
+from functools import partial
+from itertools import chain, repeat
+from typing import Callable, Optional, List, Tuple
 
-import ujson
 from websockets.exceptions import ConnectionClosedOK
 from websockets.sync.client import connect, ClientConnection
 
 from tastytrade_sdk.exceptions import TastytradeSdkException, InvalidArgument
 from tastytrade_sdk.market_data.streamer_symbol_translation import StreamerSymbolTranslations
 
+try:
+    import orjson
+
+    def _json_dumps(obj: dict) -> str:
+        return orjson.dumps(obj).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    import ujson
+
+    _json_dumps = ujson.dumps
+    _json_loads = ujson.loads
+
+_FRAME_QUEUE_SIZE = 4096
+_FEED_DATA_MARKER = b'"FEED_DATA"'
+_AUTH_TIMEOUT_SECONDS = 10.0
+
+_QUOTE_KEYS = ('Symbol', 'eventSymbol', 'bidPrice', 'askPrice', 'timeStamp')
+_CANDLE_KEYS = ('Symbol', 'eventSymbol', 'Open', 'High', 'Low', 'Close', 'Volumen', 'timeStamp')
+_GREEKS_KEYS = ('Symbol', 'eventSymbol', 'Price', 'Volatility', 'Delta', 'Gamma', 'Theta', 'Rho', 'Vega', 'timeStamp')
+
+
+def _compact_layout(stride: int, offsets: Tuple[int, ...]) -> Tuple[slice, ...]:
+    """Strided column slices (eventSymbol first) for a compact record of the given length"""
+    return tuple(slice(o, None, stride) for o in (1, *offsets))
+
+
+_LAYOUTS = {
+    'Quote': (_compact_layout(13, (7, 11)), _QUOTE_KEYS),
+    'Candle': (_compact_layout(18, (8, 9, 10, 11, 12)), _CANDLE_KEYS),
+    'Greeks': (_compact_layout(14, (7, 8, 9, 10, 11, 12, 13)), _GREEKS_KEYS)
+}
+
 
 class LoopThread(threading.Thread):
     def __init__(self, activity: Callable, timeout_seconds: int = 0):
         threading.Thread.__init__(self)
         self.__running = True
+        self.__wake = threading.Event()
         self.__activity = activity
         self.__timeout_seconds = timeout_seconds
         super().start()
@@ -29,153 +63,202 @@ class LoopThread(threading.Thread):
     def __pause(self):
         if not self.__timeout_seconds:
             return
-        start = time.time()
-        while self.__running and time.time() - start <= self.__timeout_seconds:
-            continue
+        self.__wake.wait(self.__timeout_seconds)
 
     def stop(self):
         self.__running = False
+        self.__wake.set()
 
 
-class Subscription:
-    __websocket: Optional[ClientConnection] = None
-    __keepalive_thread: Optional[LoopThread]
-    __receive_thread: Optional[LoopThread]
-    __is_authorized: bool = False
+class FrameQueue(queue.Queue):
+    def put_evicting(self, frame: Optional[bytes]) -> bool:
+        """
+        Enqueue without blocking. When full, make room by evicting the oldest FEED_DATA frame, so control frames are
+        never dropped. Returns whether a frame was evicted.
+        """
+        with self.not_full:
+            evicted = False
+            if 0 < self.maxsize <= self._qsize():
+                for i, queued in enumerate(self.queue):
+                    if queued is not None and _FEED_DATA_MARKER in queued:
+                        del self.queue[i]
+                        evicted = True
+                        break
+            self._put(frame)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return evicted
+
 
+class Subscription:
     def __init__(self, url: str, token: str, streamer_symbol_translations: StreamerSymbolTranslations,
                  on_candle: Callable[[dict], None] = None,
                  on_greeks: Callable[[dict], None] = None,
-                 on_quote: Callable[[dict], None] = None
+                 on_quote: Callable[[dict], None] = None,
+                 on_candle_batch: Callable[[List[tuple]], None] = None,
+                 on_greeks_batch: Callable[[List[tuple]], None] = None,
+                 on_quote_batch: Callable[[List[tuple]], None] = None
                  ):
         """@private"""
 
-        if not (on_quote or on_candle or on_greeks):
+        if not (on_quote or on_candle or on_greeks or on_quote_batch or on_candle_batch or on_greeks_batch):
             raise InvalidArgument('At least one feed event handler must be provided')
 
         self.__url = url
         self.__token = token
         self.__streamer_symbol_translations = streamer_symbol_translations
-        self.__on_quote = on_quote
-        self.__on_candle = on_candle
-        self.__on_greeks = on_greeks
+        self.__handlers = {event_type: handlers for event_type, handlers in (
+            ('Quote', (on_quote, on_quote_batch)),
+            ('Candle', (on_candle, on_candle_batch)),
+            ('Greeks', (on_greeks, on_greeks_batch))
+        ) if any(handlers)}
+        self.__subscriptions: Optional[List[dict]] = None
+        self.__auth_event = threading.Event()
+        self.__error: Optional[StreamerException] = None
+        self.__frames: Optional[FrameQueue] = None
+        self.__lifecycle_lock = threading.RLock()
+        self.__closed = False
+        self.__websocket: Optional[ClientConnection] = None
+        self.__keepalive_thread: Optional[LoopThread] = None
+        self.__receive_thread: Optional[LoopThread] = None
+        self.__process_thread: Optional[LoopThread] = None
 
     def open(self) -> 'Subscription':
         """Start listening for feed events"""
-        self.__websocket = connect(self.__url)
-        self.__receive_thread = LoopThread(self.__receive)
+        with self.__lifecycle_lock:
+            self.__closed = False
+            self.__auth_event.clear()
+            self.__error = None
+            self.__websocket = connect(self.__url, max_size=None, compression=None)
+            # Each connection gets its own queue so frames left over from a previous one are never processed
+            self.__frames = FrameQueue(maxsize=_FRAME_QUEUE_SIZE)
+            self.__process_thread = LoopThread(partial(self.__process, self.__frames))
+            self.__receive_thread = LoopThread(partial(self.__receive, self.__websocket, self.__frames))
 
-        subscription_types = []
-        if self.__on_quote:
-            subscription_types.append('Quote')
-        if self.__on_candle:
-            subscription_types.append('Candle')
-        if self.__on_greeks:
-            subscription_types.append('Greeks')
-
-        subscriptions = [{'symbol': s, 'type': t} for s, t in
-                         product(self.__streamer_symbol_translations.streamer_symbols, subscription_types)]
+        if self.__subscriptions is None:
+            self.__subscriptions = [{'symbol': s, 'type': t}
+                                    for s in self.__streamer_symbol_translations.streamer_symbols
+                                    for t in self.__handlers]
 
         self.__send('SETUP', version='0.1-js/1.0.0')
         self.__send('AUTH', token=self.__token)
-        while not self.__is_authorized:
-            continue
+        authorized = self.__auth_event.wait(_AUTH_TIMEOUT_SECONDS)
+        if self.__error:
+            self.close()
+            raise self.__error
+        if not authorized:
+            self.close()
+            raise StreamerException('AUTH_TIMEOUT', f'Not authorized within {_AUTH_TIMEOUT_SECONDS:g} seconds')
         self.__send('CHANNEL_REQUEST', channel=1, service='FEED', parameters={'contract': 'AUTO'})
-        self.__send('FEED_SUBSCRIPTION', channel=1, add=subscriptions)
+        # DXLink takes one JSON object per frame, so the whole subscription list goes out as a single message
+        self.__send('FEED_SUBSCRIPTION', channel=1, add=self.__subscriptions)
         return self
 
     def close(self) -> None:
         """Close the stream connection"""
-        if self.__keepalive_thread:
-            self.__keepalive_thread.stop()
-        if self.__receive_thread:
-            self.__receive_thread.stop()
-        if self.__websocket:
-            self.__websocket.close()
-
-    def __receive(self) -> None:
-        if not self.__websocket:
-            return
+        with self.__lifecycle_lock:
+            self.__closed = True
+            if self.__keepalive_thread:
+                self.__keepalive_thread.stop()
+            if self.__receive_thread:
+                self.__receive_thread.stop()
+            if self.__websocket:
+                self.__websocket.close()
+            if self.__process_thread:
+                self.__process_thread.stop()
+                self.__enqueue(self.__frames, None)
+
+    def __receive(self, websocket: ClientConnection, frames: FrameQueue) -> None:
         try:
-            message = ujson.loads(self.__websocket.recv())
+            frame = websocket.recv(decode=False)
         except ConnectionClosedOK:
             return
+        self.__enqueue(frames, frame)
+
+    @staticmethod
+    def __enqueue(frames: FrameQueue, frame: Optional[bytes]) -> None:
+        if frames.put_evicting(frame):
+            logging.warning('Feed frame queue is full, dropped the oldest feed data frame')
+
+    def __process(self, queued: FrameQueue) -> None:
+        frames = [queued.get()]
+        try:
+            while True:
+                frames.append(queued.get_nowait())
+        except queue.Empty:
+            pass
+
+        feed_data = {}
+        for frame in frames:
+            if frame is None:
+                continue
+            try:
+                message = _json_loads(frame)
+                if message['type'] == 'FEED_DATA':
+                    payload = message['data']
+                    for event_type, data in zip(payload[::2], payload[1::2]):
+                        feed_data.setdefault(event_type, []).append(data)
+                else:
+                    self.__handle_control_message(message, queued)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Failed to handle streamer frame %.200r', frame)
+
+        for event_type, chunks in feed_data.items():
+            try:
+                self.__handle_feed_event(event_type,
+                                         chunks[0] if len(chunks) == 1 else list(chain.from_iterable(chunks)))
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Failed to handle %s feed events', event_type)
+
+    def __handle_control_message(self, message: dict, queued: FrameQueue) -> None:
         _type = message['type']
-        if _type == 'ERROR':
-            raise StreamerException(message['error'], message['message'])
-        if _type == 'SETUP':
-            keepalive_interval = floor(message['keepaliveTimeout'] / 2)
-            self.__keepalive_thread = LoopThread(lambda: self.__send('KEEPALIVE'), keepalive_interval)
-        elif _type == 'AUTH_STATE':
-            self.__is_authorized = message['state'] == 'AUTHORIZED'
-        elif _type == 'FEED_DATA':
-            self.__handle_feed_event(message['data'])
-        else:
-            logging.debug('Unhandled message type: %s', _type)
-
-    def __handle_feed_event(self, event: dict) -> None:
-        event_type = event[0]
-        if event_type == 'Quote' and self.__on_quote:
-            data = self.__handle_compact_quote(event[1])
-            self.__on_quote(data)
-        elif event_type == 'Candle' and self.__on_candle:
-            data = self.__handle_compact_candle(event[1])
-            self.__on_candle(data)
-        elif event_type == 'Greeks' and self.__on_greeks:
-            data = self.__handle_compact_greeks(event[1])
-            self.__on_greeks(data)
-        else:
-            logging.debug('Unhandled feed event type %s for symbol %s', event_type)
-    
-    def __handle_compact_quote(self, data: list) -> list:
-        quote = {}
-        for i in range(0, len(data), 13):
-            event_symbol = data[i+1]
-            original_symbol = self.__streamer_symbol_translations.get_original_symbol(event_symbol)
-            quote['Symbol'] = original_symbol
-            quote['eventSymbol'] = event_symbol
-            quote['bidPrice'] = data[i+7]
-            quote['askPrice'] = data[i+11]
-            quote['timeStamp'] = time.time()
-        return quote
-
-    def __handle_compact_candle(self, data: list) -> list:
-        candle = {}
-        for i in range(0, len(data), 18):
-            event_symbol = data[i+1]
-            original_symbol = self.__streamer_symbol_translations.get_original_symbol(event_symbol)
-            candle['Symbol'] = original_symbol
-            candle['eventSymbol'] = event_symbol
-            candle['Open'] = data[i+8]
-            candle['High'] = data[i+9]
-            candle['Low'] = data[i+10]
-            candle['Close'] = data[i+11]
-            candle['Volumen'] = data[i+12]
-            candle['timeStamp'] = time.time()
-        return candle
-    
-    def __handle_compact_greeks(self, data: list) -> list:
-        greeks = {}
-        for i in range(0, len(data), 14):
-            event_symbol = data[i+1]
-            original_symbol = self.__streamer_symbol_translations.get_original_symbol(event_symbol)
-            greeks['Symbol'] = original_symbol
-            greeks['eventSymbol'] = event_symbol
-            greeks['Price'] = data[i+8]
-            greeks['Volatility'] = data[i+9]
-            greeks['Delta'] = data[i+10]
-            greeks['Gamma'] = data[i+11]
-            greeks['Theta'] = data[i+12]
-            greeks['Rho'] = data[i+13]
-            greeks['Vega'] = data[i+13]
-            greeks['timeStamp'] = time.time()
-        return greeks
+        with self.__lifecycle_lock:
+            if self.__closed or queued is not self.__frames:
+                logging.debug('Ignoring %s message from a closed connection', _type)
+                return
+            if _type == 'ERROR':
+                error = StreamerException(message['error'], message['message'])
+                if self.__auth_event.is_set():
+                    logging.error('Streamer error: %s', error)
+                else:
+                    self.__error = error
+                    self.__auth_event.set()
+            elif _type == 'SETUP':
+                keepalive_interval = message['keepaliveTimeout'] // 2
+                self.__keepalive_thread = LoopThread(lambda: self.__send('KEEPALIVE'), keepalive_interval)
+            elif _type == 'AUTH_STATE':
+                if message['state'] == 'AUTHORIZED':
+                    self.__auth_event.set()
+            else:
+                logging.debug('Unhandled message type: %s', _type)
+
+    def __handle_feed_event(self, event_type: str, data: list) -> None:
+        handlers = self.__handlers.get(event_type)
+        if not handlers:
+            logging.debug('Unhandled feed event type %s', event_type)
+            return
+        on_event, on_batch = handlers
+        columns, keys = _LAYOUTS[event_type]
+        rows = self.__decode_compact(data, columns)
+        if on_batch:
+            on_batch(rows)
+        if on_event:
+            for row in rows:
+                on_event(dict(zip(keys, row)))
+
+    def __decode_compact(self, data: list, columns: Tuple[slice, ...]) -> List[tuple]:
+        event_symbols = data[columns[0]]
+        get_original_symbol = self.__streamer_symbol_translations.get_original_symbol
+        original_symbols = {s: get_original_symbol(s) for s in set(event_symbols)}
+        return list(zip(
+            map(original_symbols.__getitem__, event_symbols),
+            event_symbols,
+            *[data[c] for c in columns[1:]],
+            repeat(time.time())
+        ))
 
     def __send(self, _type: str, channel: Optional[int] = 0, **kwargs) -> None:
-        self.__websocket.send(ujson.dumps({
-            **{'type': _type, 'channel': channel},
-            **kwargs
-        }))
+        self.__websocket.send(_json_dumps({'type': _type, 'channel': channel, **kwargs}))
 
 
 class StreamerException(TastytradeSdkException):
@@ -1,11 +1,237 @@
+import json
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
 from unittest import TestCase
+from unittest.mock import patch
+
+from websockets.exceptions import ConnectionClosedOK
 
 from tastytrade_sdk import Subscription
 from tastytrade_sdk.exceptions import InvalidArgument
 from tastytrade_sdk.market_data.streamer_symbol_translation import StreamerSymbolTranslations
+from tastytrade_sdk.market_data.subscription import FrameQueue, StreamerException
+
+
+def frame(message: dict) -> bytes:
+    return json.dumps(message).encode()
+
+
+def feed_data(*data) -> bytes:
+    return frame({'type': 'FEED_DATA', 'channel': 1, 'data': list(data)})
+
+
+def quote(symbol: str, bid_price: float, ask_price: float) -> list:
+    return ['Quote', symbol, 0, 0, 0, 0, 0, bid_price, 0, 0, 0, ask_price, 0]
+
+
+SETUP = frame({'type': 'SETUP', 'channel': 0, 'keepaliveTimeout': 60})
+AUTHORIZED = frame({'type': 'AUTH_STATE', 'channel': 0, 'state': 'AUTHORIZED'})
+
+
+class FakeConnection:
+    """Stands in for the websocket, answering each sent message type with canned frames"""
+
+    def __init__(self, replies: Dict[str, List[bytes]]):
+        self.sent = []
+        self.__replies = replies
+        self.__inbox = queue.Queue()
+        self.__recv_calls = 0
+
+    def send(self, message: str) -> None:
+        message = json.loads(message)
+        self.sent.append(message)
+        for reply in self.__replies.get(message['type'], []):
+            self.__inbox.put(reply)
+
+    def recv(self, **_) -> bytes:
+        self.__recv_calls += 1
+        reply = self.__inbox.get()
+        if reply is None:
+            self.__inbox.put(None)
+            raise ConnectionClosedOK(None, None)
+        return reply
+
+    def close(self) -> None:
+        self.__inbox.put(None)
+
+    def deliver(self, *frames: bytes) -> None:
+        """Push frames and wait until the receive loop has handed all of them on and is waiting for more"""
+        expected = self.__recv_calls + len(frames)
+        for reply in frames:
+            self.__inbox.put(reply)
+        deadline = time.monotonic() + 5
+        while self.__recv_calls < expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+class Collector:
+    """Batch handler that records every row and signals once the expected number has arrived"""
+
+    def __init__(self, expected: int):
+        self.rows = []
+        self.calls = 0
+        self.__expected = expected
+        self.__done = threading.Event()
+
+    def __call__(self, rows: list) -> None:
+        self.rows.extend(rows)
+        self.calls += 1
+        if len(self.rows) >= self.__expected:
+            self.__done.set()
+
+    def wait(self) -> bool:
+        return self.__done.wait(5)
 
 
 class SubscriptionTest(TestCase):
+    def open(self, feed: List[bytes], replies: Optional[Dict[str, List[bytes]]] = None, **handlers) -> FakeConnection:
+        connection = FakeConnection({'SETUP': [SETUP], 'AUTH': [AUTHORIZED], 'FEED_SUBSCRIPTION': feed,
+                                     **(replies or {})})
+        subscription = Subscription('url', 'token', StreamerSymbolTranslations({'SPY': 'SPY'}), **handlers)
+        with patch('tastytrade_sdk.market_data.subscription.connect', return_value=connection):
+            subscription.open()
+        self.addCleanup(subscription.close)
+        return connection
+
     def test_requires_at_least_one_event_handler(self):
         with self.assertRaises(InvalidArgument):
             Subscription('url', 'token', StreamerSymbolTranslations([]))
+
+    def test_accepts_batch_event_handler(self):
+        Subscription('url', 'token', StreamerSymbolTranslations([]), on_quote_batch=print)
+
+    def test_subscribes_to_handled_event_types(self):
+        connection = self.open([], on_quote=print, on_greeks_batch=print)
+        self.assertEqual(connection.sent[-1]['add'], [{'symbol': 'SPY', 'type': 'Quote'},
+                                                      {'symbol': 'SPY', 'type': 'Greeks'}])
+
+    def test_dispatches_feed_event_by_layout(self):
+        quotes = Collector(2)
+        self.open([
+            feed_data('Candle', ['Candle', 'SPY'] + [0] * 16),
+            feed_data('Quote', quote('SPY', 1.5, 1.6) + quote('SPY', 1.7, 1.8))
+        ], on_quote_batch=quotes)
+        self.assertTrue(quotes.wait())
+        self.assertEqual([q[:4] for q in quotes.rows], [('SPY', 'SPY', 1.5, 1.6), ('SPY', 'SPY', 1.7, 1.8)])
+
+    def test_delivers_every_queued_frame(self):
+        quotes = Collector(3)
+        self.open([feed_data('Quote', quote('SPY', 1.0, 1.1)) for _ in range(3)], on_quote_batch=quotes)
+        self.assertTrue(quotes.wait())
+        self.assertEqual(len(quotes.rows), 3)
+
+    def test_groups_event_pairs_of_one_message_into_one_batch(self):
+        quotes = Collector(2)
+        greeks = Collector(1)
+        self.open([feed_data('Quote', quote('SPY', 1.0, 1.1), 'Greeks', ['Greeks', 'SPY'] + [0] * 12,
+                             'Quote', quote('SPY', 1.2, 1.3))],
+                  on_quote_batch=quotes, on_greeks_batch=greeks)
+        self.assertTrue(quotes.wait())
+        self.assertTrue(greeks.wait())
+        self.assertEqual(quotes.calls, 1)
+        self.assertEqual([q[2:4] for q in quotes.rows], [(1.0, 1.1), (1.2, 1.3)])
+
+    def test_maps_greeks_and_candle_fields(self):
+        greeks, greeks_batch, candles, candles_batch = Collector(1), Collector(1), Collector(1), Collector(1)
+        self.open([feed_data('Greeks', ['Greeks', 'SPY'] + [100 + i for i in range(2, 14)],
+                             'Candle', ['Candle', 'SPY'] + [200 + i for i in range(2, 18)])],
+                  on_greeks=lambda event: greeks([event]), on_greeks_batch=greeks_batch,
+                  on_candle=lambda event: candles([event]), on_candle_batch=candles_batch)
+        for collector in (greeks, greeks_batch, candles, candles_batch):
+            self.assertTrue(collector.wait())
+
+        greek = greeks.rows[0]
+        self.assertEqual({k: v for k, v in greek.items() if k != 'timeStamp'}, {
+            'Symbol': 'SPY', 'eventSymbol': 'SPY', 'Price': 107, 'Volatility': 108, 'Delta': 109, 'Gamma': 110,
+            'Theta': 111, 'Rho': 112, 'Vega': 113
+        })
+        self.assertEqual(greeks_batch.rows, [('SPY', 'SPY', 107, 108, 109, 110, 111, 112, 113, greek['timeStamp'])])
+
+        candle = candles.rows[0]
+        self.assertEqual({k: v for k, v in candle.items() if k != 'timeStamp'}, {
+            'Symbol': 'SPY', 'eventSymbol': 'SPY', 'Open': 208, 'High': 209, 'Low': 210, 'Close': 211, 'Volumen': 212
+        })
+        self.assertEqual(candles_batch.rows, [('SPY', 'SPY', 208, 209, 210, 211, 212, candle['timeStamp'])])
+
+    def test_keeps_processing_after_a_handler_raises(self):
+        def fail(_):
+            raise RuntimeError('handler failed')
+
+        quotes = Collector(1)
+        with self.assertLogs(level='ERROR'):
+            self.open([feed_data('Greeks', ['Greeks', 'SPY'] + [0] * 12), feed_data('Quote', quote('SPY', 1.0, 1.1))],
+                      on_greeks_batch=fail, on_quote_batch=quotes)
+            self.assertTrue(quotes.wait())
+
+    def test_skips_malformed_frames(self):
+        quotes = Collector(1)
+        with self.assertLogs(level='ERROR'):
+            self.open([b'{"type": "FEED_DATA", "data": [', frame({'type': 'SETUP', 'channel': 0}),
+                       feed_data('Quote', quote('SPY', 1.0, 1.1))], on_quote_batch=quotes)
+            self.assertTrue(quotes.wait())
+
+    def test_open_raises_streamer_error_received_before_authorization(self):
+        unauthorized = frame({'type': 'ERROR', 'channel': 0, 'error': 'UNAUTHORIZED', 'message': 'Invalid token'})
+        with patch('tastytrade_sdk.market_data.subscription._AUTH_TIMEOUT_SECONDS', 5):
+            with self.assertRaises(StreamerException) as context:
+                self.open([], {'AUTH': [unauthorized]}, on_quote=print)
+        self.assertEqual(str(context.exception), 'UNAUTHORIZED: Invalid token')
+
+    def test_logs_streamer_error_received_after_authorization(self):
+        error = frame({'type': 'ERROR', 'channel': 0, 'error': 'TIMEOUT', 'message': 'Keepalive timed out'})
+        quotes = Collector(1)
+        with self.assertLogs(level='DEBUG') as logs:
+            self.open([error, feed_data('Quote', quote('SPY', 1.0, 1.1))], on_quote_batch=quotes)
+            self.assertTrue(quotes.wait())
+        self.assertIn('ERROR:root:Streamer error: TIMEOUT: Keepalive timed out', logs.output)
+        self.assertFalse([line for line in logs.output if 'Unhandled' in line])
+
+    def test_open_times_out_without_authorization(self):
+        with patch('tastytrade_sdk.market_data.subscription._AUTH_TIMEOUT_SECONDS', 0.1):
+            with self.assertRaises(StreamerException) as context:
+                self.open([], {'AUTH': []}, on_quote=print)
+        self.assertTrue(str(context.exception).startswith('AUTH_TIMEOUT'))
+
+    def test_reopen_ignores_frames_left_from_the_previous_connection(self):
+        entered, release = threading.Event(), threading.Event()
+        quotes = []
+
+        def on_quote_batch(rows):
+            quotes.extend(rows)
+            entered.set()
+            release.wait(5)
+
+        first = FakeConnection({'SETUP': [SETUP], 'AUTH': [AUTHORIZED],
+                                'FEED_SUBSCRIPTION': [feed_data('Quote', quote('SPY', 1.0, 1.1))]})
+        second = FakeConnection({'SETUP': [SETUP]})
+        subscription = Subscription('url', 'token', StreamerSymbolTranslations({'SPY': 'SPY'}),
+                                    on_quote_batch=on_quote_batch)
+        self.addCleanup(subscription.close)
+        self.addCleanup(release.set)
+        with patch('tastytrade_sdk.market_data.subscription.connect', side_effect=[first, second]):
+            subscription.open()
+            self.assertTrue(entered.wait(5))
+            first.deliver(AUTHORIZED, feed_data('Quote', quote('SPY', 2.0, 2.1)))
+            subscription.close()
+            with patch('tastytrade_sdk.market_data.subscription._AUTH_TIMEOUT_SECONDS', 0.2):
+                with self.assertRaises(StreamerException) as context:
+                    subscription.open()
+        self.assertTrue(str(context.exception).startswith('AUTH_TIMEOUT'))
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual([q[2:4] for q in quotes], [(1.0, 1.1)])
+        self.assertNotIn('CHANNEL_REQUEST', [message['type'] for message in second.sent])
+
+    def test_close_before_open(self):
+        Subscription('url', 'token', StreamerSymbolTranslations([]), on_quote=print).close()
+
+
+class FrameQueueTest(TestCase):
+    def test_evicts_only_feed_data_frames_when_full(self):
+        frames = FrameQueue(maxsize=3)
+        for queued in (SETUP, feed_data('Quote', quote('SPY', 1.0, 1.1)), AUTHORIZED):
+            self.assertFalse(frames.put_evicting(queued))
+        self.assertTrue(frames.put_evicting(None))
+        self.assertEqual([frames.get_nowait() for _ in range(3)], [SETUP, AUTHORIZED, None])